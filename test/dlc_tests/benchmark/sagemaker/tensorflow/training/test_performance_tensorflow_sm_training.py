@@ -1,12 +1,14 @@
 import os
 import re
 import time
+import zlib
 
-from random import Random
+from collections import deque
 
 import pytest
 
 from invoke.context import Context
+from invoke.exceptions import UnexpectedExit
 from src.benchmark_metrics import (
     TENSORFLOW_SM_TRAINING_CPU_1NODE_THRESHOLD,
     TENSORFLOW_SM_TRAINING_CPU_4NODE_THRESHOLD,
@@ -21,6 +23,33 @@ from test.test_utils import (
     get_cuda_version_from_tag,
 )
 
+_CPU_TP_RE = re.compile(r"(CPU\(s\):[ ]*)(?P<throughput>[0-9]+\.?[0-9]+)")
+_GPU_TP_RE = re.compile(r"(images/sec:[ ]*)(?P<throughput>[0-9]+\.?[0-9]+)")
+# processor -> (marker identifying a throughput line, text preceding the number, fallback regex)
+_THROUGHPUT_PARSERS = {
+    "cpu": ("Total img/sec on ", "CPU(s):", _CPU_TP_RE),
+    "gpu": ("images/sec: ", "images/sec:", _GPU_TP_RE),
+}
+
+# (s3 log path, promise) of log uploads that run in the background, joined once all tests in this
+# module have finished
+_PENDING_LOG_UPLOADS = []
+
+
+@pytest.fixture(scope="module", autouse=True)
+def wait_for_log_uploads():
+    yield
+    failed_uploads = []
+    while _PENDING_LOG_UPLOADS:
+        s3_log_path, upload = _PENDING_LOG_UPLOADS.pop()
+        try:
+            upload.join()
+        except UnexpectedExit as e:
+            LOGGER.error(f"Failed to upload {s3_log_path}: {e.result.stderr}")
+            failed_uploads.append(s3_log_path)
+    if failed_uploads:
+        raise RuntimeError(f"Failed to upload benchmark logs: {', '.join(failed_uploads)}")
+
 
 @pytest.mark.usefixtures("sagemaker_only")
 @pytest.mark.flaky(reruns=3)
@@ -69,24 +98,21 @@ def run_sm_perf_test(image_uri, num_nodes, region):
 
     ec2_instance_type = "g5.12xlarge" if processor == "gpu" else "c5.18xlarge"
 
-    py_version = "py2" if "py2" in image_uri else "py37" if "py37" in image_uri else "py3"
+    py_version = next((py for py in ("py2", "py37") if py in image_uri), "py3")
 
     time_str = time.strftime("%Y-%m-%d-%H-%M-%S")
     commit_info = os.getenv("CODEBUILD_RESOLVED_SOURCE_VERSION")
-    target_upload_location = os.path.join(
-        BENCHMARK_RESULTS_S3_BUCKET,
-        "tensorflow",
-        framework_version,
-        "sagemaker",
-        "training",
-        device_cuda_str,
-        py_version,
+    # S3 URIs always use "/" as a separator, so build them directly instead of with os.path.join
+    target_upload_location = (
+        f"{BENCHMARK_RESULTS_S3_BUCKET}/tensorflow/{framework_version}/sagemaker/training/"
+        f"{device_cuda_str}/{py_version}"
     )
     training_job_name = f"tf{framework_version[0]}-tr-bench-{device_cuda_str}-{num_nodes}-node-{py_version}-{commit_info[:7]}-{time_str}"
 
     # Inserting random sleep because this test starts multiple training jobs around the same time, resulting in
     # a throttling error for SageMaker APIs.
-    time.sleep(Random(x=training_job_name).random() * 60)
+    # The delay is derived from a hash of the job name, so it is deterministic per job.
+    time.sleep(zlib.crc32(training_job_name.encode()) / 2**32 * 60)
 
     test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "resources")
     venv_dir = os.path.join(test_dir, "sm_benchmark_venv")
@@ -103,29 +129,37 @@ def run_sm_perf_test(image_uri, num_nodes, region):
             f"--node-count {num_nodes} "
             f"--python {py_version} "
             f"--region {region} "
-            f"--job-name {training_job_name}"
+            f"--job-name {training_job_name} "
             f"2>&1 | tee {log_file}",
             warn=True,
             echo=True,
         )
 
         if not (run_out.ok or run_out.return_code == 124):
-            target_upload_location = os.path.join(target_upload_location, "failure_log")
-
-    ctx.run(
-        f"aws s3 cp {os.path.join(test_dir, log_file)} {os.path.join(target_upload_location, log_file)}"
-    )
-
-    LOGGER.info(f"Test results can be found at {os.path.join(target_upload_location, log_file)}")
-
-    result_statement, throughput = _print_results_of_test(
-        os.path.join(test_dir, log_file), processor
-    )
+            target_upload_location = f"{target_upload_location}/failure_log"
+
+    local_log_path = f"{test_dir}/{log_file}"
+    s3_log_path = f"{target_upload_location}/{log_file}"
+
+    # Parse the log while it is still in the page cache, and upload it even if parsing fails
+    try:
+        result_statement, throughput = _print_results_of_test(local_log_path, processor)
+    finally:
+        _PENDING_LOG_UPLOADS.append(
+            (
+                s3_log_path,
+                ctx.run(
+                    f"aws s3 cp --no-progress --only-show-errors {local_log_path} {s3_log_path}",
+                    asynchronous=True,
+                ),
+            )
+        )
+        LOGGER.info(f"Test results can be found at {s3_log_path}")
     throughput /= num_nodes
 
     assert run_out.ok, (
         f"Benchmark Test failed with return code {run_out.return_code}. "
-        f"Test results can be found at {os.path.join(target_upload_location, log_file)}"
+        f"Test results can be found at {s3_log_path}"
     )
 
     threshold_table = (
@@ -150,40 +184,60 @@ def run_sm_perf_test(image_uri, num_nodes, region):
     )
 
 
+def _parse_throughput(line, prefix, pattern):
+    """
+    Extract the throughput number that follows prefix in a log line. Splitting on the prefix is
+    much cheaper than running the regex, which is only kept as a fallback for unexpected lines.
+    The fast path only accepts plain decimal numbers, since float() would also parse tokens such
+    as "inf", "nan", "1e5" or "1_000" that the regex rejects.
+
+    :param line: log line containing a throughput measurement
+    :param prefix: text that immediately precedes the throughput number
+    :param pattern: compiled regex with a "throughput" group, used as a fallback
+    :return: float throughput
+    """
+    tokens = line.partition(prefix)[2].split(None, 1)
+    if tokens and tokens[0].replace(".", "", 1).isdigit() and tokens[0].isascii():
+        return float(tokens[0])
+    return float(pattern.search(line).group("throughput"))
+
+
+def _iter_throughput(f, marker, prefix, pattern):
+    """
+    Yield (line, throughput) for each throughput line of a benchmark log as it is read
+
+    :param f: file object for the benchmark log
+    :param marker: substring identifying a throughput line
+    :param prefix: text that immediately precedes the throughput number
+    :param pattern: compiled regex with a "throughput" group, used as a fallback
+    """
+    for line in f:
+        if marker in line:
+            yield line, _parse_throughput(line, prefix, pattern)
+
+
 def _print_results_of_test(file_path, processor):
-    result = ""
-    throughput = 0
+    marker, prefix, pattern = _THROUGHPUT_PARSERS[processor]
+    # GPU only uses the last 100 throughput lines, so memory stays bounded regardless of log size
+    result_dq, throughput_dq = deque(maxlen=100), deque(maxlen=100)
+    total_throughput = 0
+    with open(file_path, "r", buffering=1 << 20) as f:
+        for line, line_throughput in _iter_throughput(f, marker, prefix, pattern):
+            result_dq.append(line)
+            throughput_dq.append(line_throughput)
+            total_throughput += line_throughput
+
     if processor == "cpu":
-        with open(file_path, "r") as f:
-            lines = f.readlines()
-            for line in lines:
-                if "Total img/sec on " in line:
-                    result = line + "\n"
-                    throughput += float(
-                        re.search(r"(CPU\(s\):[ ]*)(?P<throughput>[0-9]+\.?[0-9]+)", line).group(
-                            "throughput"
-                        )
-                    )
-    elif processor == "gpu":
-        """calculate average throughput"""
-        result_list, throughput_list = [], []
-        with open(file_path, "r") as f:
-            lines = f.readlines()
-            for line in lines:
-                if "images/sec: " in line:
-                    result_list.append(line.strip("\n"))
-                    throughput = float(
-                        re.search(r"(images/sec:[ ]*)(?P<throughput>[0-9]+\.?[0-9]+)", line).group(
-                            "throughput"
-                        )
-                    )
-                    throughput_list.append(throughput)
-        result = "\n".join(result_list[-100:]) + "\n"
-        if len(throughput_list) == 0:
+        # CPU logs report per-node totals, so add all of them up
+        result = result_dq[-1] + "\n" if result_dq else ""
+        throughput = total_throughput
+    else:
+        if not throughput_dq:
             raise Exception(
                 "Cannot find throughput lines. Looks like SageMaker job was not run successfully. Please check"
             )
+        result = "\n".join(line.strip("\n") for line in result_dq) + "\n"
         # Take average of last 100 throughput lines
-        throughput = sum(throughput_list[-100:]) / len(throughput_list[-100:])
+        throughput = sum(throughput_dq) / len(throughput_dq)
     LOGGER.info(result)
     return result, throughput
@@ -15,8 +15,6 @@ from __future__ import absolute_import
 import os
 
 import pytest
-import sagemaker.huggingface
-from sagemaker.huggingface import HuggingFace
 
 from ..... import invoke_sm_helper_function
 from test.test_utils import (
@@ -28,7 +26,6 @@ from packaging.version import Version
 from packaging.specifiers import SpecifierSet
 from ...integration import DEFAULT_TIMEOUT
 from ...integration.sagemaker.timeout import timeout
-import sagemaker
 import re
 
 # configurations for running training on smdistributed Data Parallel
@@ -116,6 +113,10 @@ def test_smdp_question_answering_multinode(ecr_image, sagemaker_regions, py_vers
 def _test_smdp_question_answering_function(
     ecr_image, sagemaker_session, py_version, instances_quantity
 ):
+    # Imported here so that collecting (or deselecting) these tests does not pay for the SDK import
+    import sagemaker
+    from sagemaker.huggingface import HuggingFace
+
     transformers_version = get_transformers_version_from_image_uri(ecr_image)
     git_config = {
         "repo": "https://github.com/huggingface/transformers.git",
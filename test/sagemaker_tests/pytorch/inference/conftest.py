@@ -16,16 +16,15 @@ import json
 import logging
 import os
 import platform
+import re
 import shutil
 import sys
 import tempfile
 
-import boto3
-import pytest
+from functools import lru_cache
+from types import SimpleNamespace
 
-from botocore.exceptions import ClientError
-from sagemaker import LocalSession, Session
-from sagemaker.pytorch import PyTorch
+import pytest
 
 from .utils import image_utils, get_ecr_registry
 from .. import NO_P4_REGIONS, NO_G5_REGIONS
@@ -40,6 +39,9 @@ logging.getLogger("connectionpool.py").setLevel(logging.INFO)
 
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
+_IS_DARWIN = platform.system() == "Darwin"
+_NO_P4_REGIONS = frozenset(NO_P4_REGIONS)
+_NO_G5_REGIONS = frozenset(NO_G5_REGIONS)
 
 
 def pytest_addoption(parser):
@@ -90,14 +92,11 @@ def pytest_runtest_setup(item):
 
 def pytest_collection_modifyitems(session, config, items):
     for item in items:
-        print(f"item {item}")
-        for marker in item.iter_markers(name="team"):
-            print(f"item {marker}")
-            team_name = marker.args[0]
-            item.user_properties.append(("team_marker", team_name))
-            print(f"item.user_properties {item.user_properties}")
-
-    if config.getoption("--generate-coverage-doc"):
+        team_marker = item.get_closest_marker("team")
+        if team_marker:
+            item.user_properties.append(("team_marker", team_marker.args[0]))
+
+    if config.getoption("--generate-coverage-doc") and items:
         from test.test_utils.test_reporting import TestReportGenerator
 
         report_generator = TestReportGenerator(items, is_sagemaker=True)
@@ -128,7 +127,7 @@ def fixture_framework_version(request):
 @pytest.fixture(scope="session", name="sagemaker_regions")
 def fixture_sagemaker_region(request):
     sagemaker_regions = request.config.getoption("--sagemaker-regions")
-    return sagemaker_regions.split(",")
+    return tuple(region.strip() for region in sagemaker_regions.split(","))
 
 
 @pytest.fixture(scope="session", name="py_version")
@@ -143,9 +142,9 @@ def fixture_processor(request):
 
 @pytest.fixture(scope="session", name="tag")
 def fixture_tag(request, framework_version, processor, py_version):
-    provided_tag = request.config.getoption("--tag")
-    default_tag = "{}-{}-{}".format(framework_version, processor, py_version)
-    return provided_tag if provided_tag else default_tag
+    return request.config.getoption("--tag") or "{}-{}-{}".format(
+        framework_version, processor, py_version
+    )
 
 
 @pytest.fixture(scope="session", name="docker_image")
@@ -153,19 +152,27 @@ def fixture_docker_image(docker_base_name, tag):
     return "{}:{}".format(docker_base_name, tag)
 
 
-@pytest.fixture
-def opt_ml():
+@pytest.fixture(scope="module", name="opt_ml_root")
+def fixture_opt_ml_root():
     tmp = tempfile.mkdtemp()
-    os.mkdir(os.path.join(tmp, "output"))
 
     # Docker cannot mount Mac OS /var folder properly see
     # https://forums.docker.com/t/var-folders-isnt-mounted-properly/9600
-    opt_ml_dir = "/private{}".format(tmp) if platform.system() == "Darwin" else tmp
+    opt_ml_dir = "/private{}".format(tmp) if _IS_DARWIN else tmp
     yield opt_ml_dir
 
     shutil.rmtree(tmp, True)
 
 
+@pytest.fixture
+def opt_ml(opt_ml_root):
+    # The directory is shared by the tests in a module, so give each test an empty output folder
+    output_dir = os.path.join(opt_ml_root, "output")
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir, exist_ok=True)
+    return opt_ml_root
+
+
 @pytest.fixture(scope="session", name="use_gpu")
 def fixture_use_gpu(processor):
     return processor == "gpu"
@@ -189,14 +196,25 @@ def fixture_build_base_image(
     return tag
 
 
+@pytest.fixture(scope="session", name="boto_session")
+def fixture_boto_session(region):
+    import boto3
+
+    return boto3.Session(region_name=region)
+
+
 @pytest.fixture(scope="session", name="sagemaker_session")
-def fixture_sagemaker_session(region):
-    return Session(boto_session=boto3.Session(region_name=region))
+def fixture_sagemaker_session(boto_session):
+    from sagemaker import Session
+
+    return Session(boto_session=boto_session)
 
 
 @pytest.fixture(scope="session", name="sagemaker_local_session")
-def fixture_sagemaker_local_session(region):
-    return LocalSession(boto_session=boto3.Session(region_name=region))
+def fixture_sagemaker_local_session(boto_session):
+    from sagemaker import LocalSession
+
+    return LocalSession(boto_session=boto_session)
 
 
 @pytest.fixture(name="aws_id", scope="session")
@@ -226,81 +244,130 @@ def fixture_ecr_image(docker_registry, docker_base_name, tag):
     return "{}/{}:{}".format(docker_registry, docker_base_name, tag)
 
 
-@pytest.fixture(autouse=True)
-def skip_based_on_image_and_marker_combination(request, ecr_image):
-    is_stabilityai_only_test = request.node.get_closest_marker("stabilityai_only") is not None
-    if is_stabilityai_only_test and "stabilityai" not in ecr_image:
+@pytest.fixture(name="image_flags", scope="session")
+def fixture_image_flags(ecr_image):
+    """
+    Image predicates used by the skip checks, computed once per session
+    """
+    return SimpleNamespace(is_stabilityai="stabilityai" in ecr_image)
+
+
+@pytest.fixture(name="env_flags", scope="session")
+def fixture_env_flags(use_gpu, accelerator_type, region, py_version):
+    """
+    Predicates used by the skip checks that only depend on session-scoped options, so they are
+    computed once instead of for every test. Instance type predicates are computed per test by
+    _get_instance_flags, because some tests parametrize instance_type.
+    """
+    return SimpleNamespace(
+        use_gpu=use_gpu,
+        is_eia=accelerator_type is not None,
+        is_no_p4_region=region in _NO_P4_REGIONS,
+        is_no_g5_region=region in _NO_G5_REGIONS,
+        is_py2="py2" in py_version,
+    )
+
+
+def _get_instance_flags(env_flags, instance_type):
+    """
+    :param env_flags: session predicates from the env_flags fixture
+    :param instance_type: instance type used by the current test
+    :return: SimpleNamespace of instance type predicates for the current test
+    """
+    return SimpleNamespace(
+        is_gpu=env_flags.use_gpu or instance_type[3:4] in ("g", "p"),
+        is_neuron_inst=instance_type.startswith("ml.inf1"),
+        is_neuronx_inst=instance_type.startswith("ml.trn1") or instance_type.startswith("ml.inf2"),
+        is_p4_restricted=env_flags.is_no_p4_region and instance_type.startswith("ml.p4"),
+        is_g5_restricted=env_flags.is_no_g5_region and instance_type.startswith("ml.g5"),
+    )
+
+
+def _get_marker_names(node):
+    """
+    Collect the names of all markers applied to a test node in a single pass
+
+    :param node: pytest test node
+    :return: set of marker names
+    """
+    return {marker.name for marker in node.iter_markers()}
+
+
+def _skip_based_on_image_and_marker_combination(marker_names, image_flags, ecr_image):
+    is_stabilityai_only_test = "stabilityai_only" in marker_names
+    if is_stabilityai_only_test and not image_flags.is_stabilityai:
         pytest.skip(
             f"Skipping because {ecr_image} is not StabilityAI image and the test is supposed to run for only stability images"
         )
 
-    is_skip_stabilityai_test = request.node.get_closest_marker("skip_stabilityai") is not None
-    if is_skip_stabilityai_test and "stabilityai" in ecr_image:
+    is_skip_stabilityai_test = "skip_stabilityai" in marker_names
+    if is_skip_stabilityai_test and image_flags.is_stabilityai:
         pytest.skip(
             f"Skipping because {ecr_image} is StabilityAI image and the test is not StabilityAI test."
         )
 
 
-@pytest.fixture(autouse=True)
-def skip_by_device_type(request, use_gpu, instance_type, accelerator_type):
-    is_gpu = use_gpu or instance_type[3] in ["g", "p"]
-    is_eia = accelerator_type is not None
-
-    is_neuron_inst = instance_type.startswith("ml.inf1")
-    is_neuronx_inst = instance_type.startswith("ml.trn1") or instance_type.startswith("ml.inf2")
+def _skip_by_device_type(marker_names, env_flags, instance_flags, instance_type):
+    is_neuron_test = "neuron_test" in marker_names
+    is_neuronx_test = "neuronx_test" in marker_names
 
-    is_neuron_test = request.node.get_closest_marker("neuron_test") is not None
-    is_neuronx_test = request.node.get_closest_marker("neuronx_test") is not None
-
-    if is_neuron_test != is_neuron_inst or is_neuronx_test != is_neuronx_inst:
+    if (
+        is_neuron_test != instance_flags.is_neuron_inst
+        or is_neuronx_test != instance_flags.is_neuronx_inst
+    ):
         pytest.skip("Skipping because test running on '{}' instance".format(instance_type))
 
     # When running GPU test, skip CPU  and neuron test. When running CPU test, skip GPU  and neuron test.
-    elif (request.node.get_closest_marker("gpu_test") and not is_gpu) or (
-        request.node.get_closest_marker("cpu_test") and is_gpu
+    elif ("gpu_test" in marker_names and not instance_flags.is_gpu) or (
+        "cpu_test" in marker_names and instance_flags.is_gpu
     ):
         pytest.skip("Skipping because running on '{}' instance".format(instance_type))
 
     # When running EIA test, skip the CPU, GPU and Neuron functions
-    elif (
-        request.node.get_closest_marker("gpu_test") or request.node.get_closest_marker("cpu_test")
-    ) and is_eia:
+    elif ("gpu_test" in marker_names or "cpu_test" in marker_names) and env_flags.is_eia:
         pytest.skip("Skipping because running on '{}' instance".format(instance_type))
 
     # When running CPU or GPU or Neuron test, skip EIA test.
-    elif request.node.get_closest_marker("eia_test") and not is_eia:
+    elif "eia_test" in marker_names and not env_flags.is_eia:
         pytest.skip("Skipping because running on '{}' instance".format(instance_type))
 
 
-@pytest.fixture(autouse=True)
-def skip_by_py_version(request, py_version):
-    if request.node.get_closest_marker("skip_py2") and "py2" in py_version:
+def _skip_by_py_version(marker_names, env_flags):
+    if "skip_py2" in marker_names and env_flags.is_py2:
         pytest.skip("Skipping the test because Python 2 is not supported.")
 
 
-@pytest.fixture(autouse=True)
-def skip_gpu_instance_restricted_regions(region, instance_type):
-    if (region in NO_P4_REGIONS and instance_type.startswith("ml.p4")) or (
-        region in NO_G5_REGIONS and instance_type.startswith("ml.g5")
-    ):
+def _skip_gpu_instance_restricted_regions(instance_flags, region, instance_type):
+    if instance_flags.is_p4_restricted or instance_flags.is_g5_restricted:
         pytest.skip(
             "Skipping GPU test in region {} with instance type {}".format(region, instance_type)
         )
 
 
-@pytest.fixture(autouse=True)
-def skip_gpu_py2(request, use_gpu, instance_type, py_version, framework_version):
-    is_gpu = use_gpu or instance_type[3] in ["g", "p"]
+def _skip_gpu_py2(marker_names, env_flags, instance_flags, framework_version):
     if (
-        request.node.get_closest_marker("skip_gpu_py2")
-        and is_gpu
-        and "py2" in py_version
+        "skip_gpu_py2" in marker_names
+        and instance_flags.is_gpu
+        and env_flags.is_py2
         and framework_version == "1.4.0"
     ):
         pytest.skip("Skipping the test until mms issue resolved.")
 
 
+# Remote override flags from the last successful fetch, or None if they have not been fetched yet
+_remote_override_flags = None
+
+
 def _get_remote_override_flags():
+    # The override flags don't change during a test session, so only fetch them from S3 once.
+    # Failed fetches are not cached, so that a transient error is retried by the next test.
+    global _remote_override_flags
+    if _remote_override_flags is not None:
+        return _remote_override_flags
+
+    import boto3
+    from botocore.exceptions import ClientError
+
     try:
         s3_client = boto3.client("s3")
         sts_client = boto3.client("sts")
@@ -308,11 +375,23 @@ def _get_remote_override_flags():
         result = s3_client.get_object(
             Bucket=f"dlc-cicd-helper-{account_id}", Key="override_tests_flags.json"
         )
-        json_content = json.loads(result["Body"].read().decode("utf-8"))
+        _remote_override_flags = json.loads(result["Body"].read().decode("utf-8"))
     except ClientError as e:
-        logger.warning("ClientError when performing S3/STS operation: {}".format(e))
-        json_content = {}
-    return json_content
+        logger.warning("ClientError when performing S3/STS operation: %s", e)
+        return {}
+    return _remote_override_flags
+
+
+@lru_cache(maxsize=None)
+def _get_disabled_tests_pattern(test_keywords):
+    """
+    Compile disabled test keywords into a single regex alternation. An empty keyword list
+    produces an empty pattern, which matches (and so disables) every test.
+
+    :param test_keywords: tuple of str keywords of the disabled tests
+    :return: compiled regex
+    """
+    return re.compile("|".join(map(re.escape, test_keywords)))
 
 
 def _is_test_disabled(test_name, build_name, version):
@@ -332,29 +411,48 @@ def _is_test_disabled(test_name, build_name, version):
     :param version: str Source Version of current execution
     :return: bool True if test is disabled as per remote override, False otherwise
     """
-    remote_override_flags = _get_remote_override_flags()
-    remote_override_build = remote_override_flags.get(build_name, {})
+    remote_override_build = _get_remote_override_flags().get(build_name, {})
     if version in remote_override_build:
-        return not remote_override_build[version] or any(
-            [test_keyword in test_name for test_keyword in remote_override_build[version]]
-        )
+        disabled_tests_pattern = _get_disabled_tests_pattern(tuple(remote_override_build[version]))
+        return disabled_tests_pattern.search(test_name) is not None
     return False
 
 
-@pytest.fixture(autouse=True)
-def disable_test(request):
-    test_name = request.node.name
+@pytest.fixture(name="codebuild_build_info", scope="session")
+def fixture_codebuild_build_info():
+    """
+    :return: tuple of CodeBuild project name and resolved source version, either of which may be None
+    """
     # We do not have a regex pattern to find CB name, which means we must resort to string splitting
     build_arn = os.getenv("CODEBUILD_BUILD_ARN")
     build_name = build_arn.split("/")[-1].split(":")[0] if build_arn else None
     version = os.getenv("CODEBUILD_RESOLVED_SOURCE_VERSION")
+    return build_name, version
+
+
+def _disable_test(request, codebuild_build_info):
+    test_name = request.node.name
+    build_name, version = codebuild_build_info
 
     if build_name and version and _is_test_disabled(test_name, build_name, version):
         pytest.skip(f"Skipping {test_name} test because it has been disabled.")
 
 
-@pytest.fixture(autouse=True)
-def skip_test_successfully_executed_before(request):
+@pytest.fixture(name="lastfailed_test_names", scope="session")
+def fixture_lastfailed_test_names(request):
+    """
+    Names of the tests recorded in "cache/lastfailed", read once per session. Node IDs are reduced
+    to the test name (the part after the last "::") so that each test is a single set lookup.
+
+    :return: frozenset of failed test names, or None if there is no lastfailed cache
+    """
+    lastfailed = request.config.cache.get("cache/lastfailed", None)
+    if lastfailed is None:
+        return None
+    return frozenset(nodeid.rsplit("::", 1)[-1] for nodeid in lastfailed)
+
+
+def _skip_test_successfully_executed_before(request, lastfailed_test_names):
     """
     "cache/lastfailed" contains information about failed tests only. We're running SM tests in separate threads for each image.
     So when we retry SM tests, successfully executed tests executed again because pytest doesn't have that info in /.cache.
@@ -363,9 +461,33 @@ def skip_test_successfully_executed_before(request):
     The method checks whether lastfailed file exists and the test name is not in it.
     """
     test_name = request.node.name
-    lastfailed = request.config.cache.get("cache/lastfailed", None)
 
-    if lastfailed is not None and not any(
-        test_name in failed_test_name for failed_test_name in lastfailed.keys()
-    ):
+    if lastfailed_test_names is not None and test_name not in lastfailed_test_names:
         pytest.skip(f"Skipping {test_name} because it was successfully executed for this commit")
+
+
+@pytest.fixture(autouse=True)
+def skip_test_by_conditions(
+    request,
+    ecr_image,
+    image_flags,
+    env_flags,
+    instance_type,
+    region,
+    framework_version,
+    codebuild_build_info,
+    lastfailed_test_names,
+):
+    """
+    Run all the skip checks for a test from a single autouse fixture. Each check calls pytest.skip,
+    so the first matching condition stops the remaining checks from running.
+    """
+    marker_names = _get_marker_names(request.node)
+    _skip_based_on_image_and_marker_combination(marker_names, image_flags, ecr_image)
+    instance_flags = _get_instance_flags(env_flags, instance_type)
+    _skip_by_device_type(marker_names, env_flags, instance_flags, instance_type)
+    _skip_by_py_version(marker_names, env_flags)
+    _skip_gpu_instance_restricted_regions(instance_flags, region, instance_type)
+    _skip_gpu_py2(marker_names, env_flags, instance_flags, framework_version)
+    _disable_test(request, codebuild_build_info)
+    _skip_test_successfully_executed_before(request, lastfailed_test_names)
@@ -14,6 +14,9 @@ from __future__ import absolute_import
 
 import os
 
+from functools import lru_cache
+from types import MappingProxyType
+
 import boto3
 import pytest
 import sagemaker
@@ -41,6 +44,72 @@ from . import invoke_pytorch_estimator
 
 MULTI_GPU_INSTANCE = "ml.g5.12xlarge"
 RESOURCE_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "resources")
+MPI_OPTIONS = (
+    "-verbose --mca orte_base_help_aggregate 0 -x SMDEBUG_LOG_LEVEL=error "
+    "-x OMPI_MCA_btl_vader_single_copy_mechanism=none "
+)
+EFA_MPI_OPTIONS = f"{MPI_OPTIONS}-x FI_EFA_USE_DEVICE_RDMA=1 -x FI_PROVIDER=efa "
+
+# Version ranges used to gate the tests below, parsed once at import time
+MIN_SMMODELPARALLEL_CUDA_VERSION = Version("110")
+SMMODELPARALLEL_FRAMEWORK_VERSIONS = SpecifierSet(">=1.6")
+SMMODELPARALLEL_EFA_FRAMEWORK_VERSIONS = SpecifierSet(">=1.8.1")
+SMP_V110_FRAMEWORK_VERSIONS = SpecifierSet(">=1.11.0")
+FASTAI_UNSUPPORTED_FRAMEWORK_VERSIONS = SpecifierSet(">=1.9,<1.13")
+FASTAI_UNRELEASED_FRAMEWORK_VERSIONS = SpecifierSet("~=2.6.0")
+PT_19_VERSIONS = SpecifierSet("==1.9.*")
+PT_BEFORE_112_VERSIONS = SpecifierSet("<1.12.0")
+
+# Hyperparameters and smdistributed modelparallel parameters shared by the GPT-2 tests. Tests add
+# their own parallelism settings on top of these read-only copies.
+GPT2_BASE_HYPERPARAMETERS = MappingProxyType(
+    {
+        "training_dir": "/opt/ml/input/data/train",
+        "max_steps": 100,
+        "seed": 12345,
+        "fp16": 1,
+        "lr": 2.0e-4,
+        "lr_decay_iters": 125000,
+        "min_lr": 0.00001,
+        "lr-decay-style": "linear",
+        "warmup": 0.01,
+        "logging_freq": 1,
+        "max_context_width": 1024,
+        "hidden_width": 768,
+        "num_layers": 12,
+        "num_heads": 12,
+        "n_gpus": 8,
+        "microbatches": 1,
+        "activation_checkpointing": 1,
+        "activation_strategy": "group_2",
+        "manual_partition": 1,
+    }
+)
+GPT2_BASE_MP_PARAMETERS = MappingProxyType(
+    {
+        "microbatches": 1,
+        "optimize": "speed",
+        "pipeline": "interleaved",
+        "ddp": True,
+        "auto_partition": False,
+        "default_partition": 0,
+        "prescaled_batch": True,
+    }
+)
+
+
+@lru_cache(maxsize=1)
+def _get_gpt2_inputs():
+    """
+    Training inputs shared by the GPT-2 tests. The same channel is used for both train and test.
+    """
+    train = sagemaker.session.s3_input(
+        "s3://gpt2-data/train_synthetic_small/",
+        distribution="FullyReplicated",
+        content_type="application/tfrecord",
+        s3_data_type="S3Prefix",
+    )
+    return {"train": train, "test": train}
 
 
 def validate_or_skip_smmodelparallel(ecr_image):
@@ -51,9 +120,10 @@ def validate_or_skip_smmodelparallel(ecr_image):
 def can_run_smmodelparallel(ecr_image):
     _, image_framework_version = get_framework_and_version_from_tag(ecr_image)
     image_cuda_version = get_cuda_version_from_tag(ecr_image)
-    return Version(image_framework_version) in SpecifierSet(">=1.6") and Version(
-        image_cuda_version.strip("cu")
-    ) >= Version("110")
+    return (
+        Version(image_framework_version) in SMMODELPARALLEL_FRAMEWORK_VERSIONS
+        and Version(image_cuda_version.strip("cu")) >= MIN_SMMODELPARALLEL_CUDA_VERSION
+    )
 
 
 def validate_or_skip_smmodelparallel_efa(ecr_image):
@@ -69,9 +139,10 @@ def skip_unsupported_instances_smmodelparallel(instance_type):
 def can_run_smmodelparallel_efa(ecr_image):
     _, image_framework_version = get_framework_and_version_from_tag(ecr_image)
     image_cuda_version = get_cuda_version_from_tag(ecr_image)
-    return Version(image_framework_version) in SpecifierSet(">=1.8.1") and Version(
-        image_cuda_version.strip("cu")
-    ) >= Version("110")
+    return (
+        Version(image_framework_version) in SMMODELPARALLEL_EFA_FRAMEWORK_VERSIONS
+        and Version(image_cuda_version.strip("cu")) >= MIN_SMMODELPARALLEL_CUDA_VERSION
+    )
 
 
 @pytest.mark.processor("cpu")
@@ -148,9 +219,9 @@ def test_dist_operations_multi_gpu(
 @pytest.mark.team("conda")
 def test_dist_operations_fastai_gpu(framework_version, ecr_image, sagemaker_regions):
     _, image_framework_version = get_framework_and_version_from_tag(ecr_image)
-    if Version(image_framework_version) in SpecifierSet(">=1.9,<1.13"):
+    if Version(image_framework_version) in FASTAI_UNSUPPORTED_FRAMEWORK_VERSIONS:
         pytest.skip("Fast ai is not supported on PyTorch v1.9.x, v1.10.x, v1.11.x, v1.12.x")
-    if Version(image_framework_version) in SpecifierSet("~=2.6.0"):
+    if Version(image_framework_version) in FASTAI_UNRELEASED_FRAMEWORK_VERSIONS:
         pytest.skip("Fast ai doesn't release for PyTorch v2.6.x")
 
     with timeout(minutes=DEFAULT_TIMEOUT):
@@ -189,57 +260,27 @@ def test_smmodelparallel_gpt2_multigpu_singlenode(
     Tests pt gpt2 command via script mode
     """
     framework, framework_version = get_framework_and_version_from_tag(ecr_image)
-    if framework == "pytorch" and Version(framework_version) in SpecifierSet("==1.9.*"):
+    if framework == "pytorch" and Version(framework_version) in PT_19_VERSIONS:
         pytest.skip("Skipping the test for PT1.9")
     instance_type = "ml.p4d.24xlarge"
     smp_version = (
         110
-        if framework == "pytorch" and Version(framework_version) in SpecifierSet(">=1.11.0")
+        if framework == "pytorch" and Version(framework_version) in SMP_V110_FRAMEWORK_VERSIONS
         else 109
     )
     hyperparameters = {
-        "training_dir": "/opt/ml/input/data/train",
-        "max_steps": 100,
-        "seed": 12345,
-        "fp16": 1,
-        "lr": 2.0e-4,
-        "lr_decay_iters": 125000,
-        "min_lr": 0.00001,
-        "lr-decay-style": "linear",
-        "warmup": 0.01,
-        "logging_freq": 1,
-        "max_context_width": 1024,
-        "hidden_width": 768,
-        "num_layers": 12,
-        "num_heads": 12,
-        "n_gpus": 8,
+        **GPT2_BASE_HYPERPARAMETERS,
         "train_batch_size": 32,
-        "microbatches": 1,
         "tensor_parallel_degree": 4,
         "pipeline_parallel_degree": 2,
-        "activation_checkpointing": 1,
-        "activation_strategy": "group_2",
-        "manual_partition": 1,
         "smp_version": smp_version,
     }
-    train = sagemaker.session.s3_input(
-        "s3://gpt2-data/train_synthetic_small/",
-        distribution="FullyReplicated",
-        content_type="application/tfrecord",
-        s3_data_type="S3Prefix",
-    )
-    inputs = {"train": train, "test": train}
+    inputs = _get_gpt2_inputs()
     validate_or_skip_smmodelparallel(ecr_image)
     mp_params = {
+        **GPT2_BASE_MP_PARAMETERS,
         "partitions": 2,
         "tensor_parallel_degree": 4,
-        "microbatches": 1,
-        "optimize": "speed",
-        "pipeline": "interleaved",
-        "ddp": True,
-        "auto_partition": False,
-        "default_partition": 0,
-        "prescaled_batch": True,
         "shard_optimizer_state": True,
     }
     if smp_version >= 110:
@@ -262,7 +303,7 @@ def test_smmodelparallel_gpt2_multigpu_singlenode(
                 "mpi": {
                     "enabled": True,
                     "processes_per_host": num_processes,
-                    "custom_mpi_options": "-verbose --mca orte_base_help_aggregate 0 -x SMDEBUG_LOG_LEVEL=error -x OMPI_MCA_btl_vader_single_copy_mechanism=none ",
+                    "custom_mpi_options": MPI_OPTIONS,
                 },
             },
         }
@@ -293,59 +334,29 @@ def test_smmodelparallel_gpt2_multigpu_singlenode_flashattn(
     Tests pt gpt2 command via script mode
     """
     framework, framework_version = get_framework_and_version_from_tag(ecr_image)
-    if Version(framework_version) in SpecifierSet("<1.12.0"):
+    if Version(framework_version) in PT_BEFORE_112_VERSIONS:
         pytest.skip("Skipping the test for older than PT 1.12")
     instance_type = "ml.p4d.24xlarge"
     smp_version = (
         110
-        if framework == "pytorch" and Version(framework_version) in SpecifierSet(">=1.11.0")
+        if framework == "pytorch" and Version(framework_version) in SMP_V110_FRAMEWORK_VERSIONS
         else 109
     )
     hyperparameters = {
-        "training_dir": "/opt/ml/input/data/train",
-        "max_steps": 100,
-        "seed": 12345,
-        "fp16": 1,
-        "lr": 2.0e-4,
-        "lr_decay_iters": 125000,
-        "min_lr": 0.00001,
-        "lr-decay-style": "linear",
-        "warmup": 0.01,
-        "logging_freq": 1,
-        "max_context_width": 1024,
-        "hidden_width": 768,
-        "num_layers": 12,
-        "num_heads": 12,
-        "n_gpus": 8,
+        **GPT2_BASE_HYPERPARAMETERS,
         "train_batch_size": 32,
-        "microbatches": 1,
         "tensor_parallel_degree": 4,
         "pipeline_parallel_degree": 2,
-        "activation_checkpointing": 1,
-        "activation_strategy": "group_2",
-        "manual_partition": 1,
         "smp_version": smp_version,
         "query_key_layer_scaling": 0,
         "assert_flash_attn": 1,
     }
-    train = sagemaker.session.s3_input(
-        "s3://gpt2-data/train_synthetic_small/",
-        distribution="FullyReplicated",
-        content_type="application/tfrecord",
-        s3_data_type="S3Prefix",
-    )
-    inputs = {"train": train, "test": train}
+    inputs = _get_gpt2_inputs()
     validate_or_skip_smmodelparallel(ecr_image)
     mp_params = {
+        **GPT2_BASE_MP_PARAMETERS,
         "partitions": 2,
         "tensor_parallel_degree": 4,
-        "microbatches": 1,
-        "optimize": "speed",
-        "pipeline": "interleaved",
-        "ddp": True,
-        "auto_partition": False,
-        "default_partition": 0,
-        "prescaled_batch": True,
         "shard_optimizer_state": True,
     }
     if smp_version >= 110:
@@ -368,7 +379,7 @@ def test_smmodelparallel_gpt2_multigpu_singlenode_flashattn(
                 "mpi": {
                     "enabled": True,
                     "processes_per_host": num_processes,
-                    "custom_mpi_options": "-verbose --mca orte_base_help_aggregate 0 -x SMDEBUG_LOG_LEVEL=error -x OMPI_MCA_btl_vader_single_copy_mechanism=none ",
+                    "custom_mpi_options": MPI_OPTIONS,
                 },
             },
         }
@@ -431,7 +442,7 @@ def test_smmodelparallel_mnist_multigpu_multinode(
                 "mpi": {
                     "enabled": True,
                     "processes_per_host": num_processes,
-                    "custom_mpi_options": "-verbose --mca orte_base_help_aggregate 0 -x SMDEBUG_LOG_LEVEL=error -x OMPI_MCA_btl_vader_single_copy_mechanism=none ",
+                    "custom_mpi_options": MPI_OPTIONS,
                 },
             },
         }
@@ -491,7 +502,7 @@ def test_hc_smmodelparallel_mnist_multigpu_multinode(
                 "mpi": {
                     "enabled": True,
                     "processes_per_host": num_processes,
-                    "custom_mpi_options": "-verbose --mca orte_base_help_aggregate 0 -x SMDEBUG_LOG_LEVEL=error -x OMPI_MCA_btl_vader_single_copy_mechanism=none ",
+                    "custom_mpi_options": MPI_OPTIONS,
                 },
                 "instance_groups": [training_group],
             },
@@ -552,7 +563,7 @@ def test_smmodelparallel_mnist_multigpu_multinode_efa(
                 "mpi": {
                     "enabled": True,
                     "processes_per_host": num_processes,
-                    "custom_mpi_options": "-verbose --mca orte_base_help_aggregate 0 -x SMDEBUG_LOG_LEVEL=error -x OMPI_MCA_btl_vader_single_copy_mechanism=none -x FI_EFA_USE_DEVICE_RDMA=1 -x FI_PROVIDER=efa ",
+                    "custom_mpi_options": EFA_MPI_OPTIONS,
                 },
             },
         }
@@ -580,53 +591,23 @@ def test_smmodelparallel_gpt2_sdp_multinode_efa(
     Tests pt gpt2 command via script mode
     """
     framework, framework_version = get_framework_and_version_from_tag(ecr_image)
-    if framework == "pytorch" and Version(framework_version) in SpecifierSet("<1.12.0"):
+    if framework == "pytorch" and Version(framework_version) in PT_BEFORE_112_VERSIONS:
         pytest.skip("Skipping the test for PT version before 1.12")
     smp_version = 111
     hyperparameters = {
-        "training_dir": "/opt/ml/input/data/train",
-        "max_steps": 100,
-        "seed": 12345,
-        "fp16": 1,
-        "lr": 2.0e-4,
-        "lr_decay_iters": 125000,
-        "min_lr": 0.00001,
-        "lr-decay-style": "linear",
-        "warmup": 0.01,
-        "logging_freq": 1,
-        "max_context_width": 1024,
-        "hidden_width": 768,
-        "num_layers": 12,
-        "num_heads": 12,
-        "n_gpus": 8,
+        **GPT2_BASE_HYPERPARAMETERS,
         "train_batch_size": 4,
-        "microbatches": 1,
         "tensor_parallel_degree": 1,
         "pipeline_parallel_degree": 1,
-        "activation_checkpointing": 1,
-        "activation_strategy": "group_2",
-        "manual_partition": 1,
         "smp_version": smp_version,
     }
-    train = sagemaker.session.s3_input(
-        "s3://gpt2-data/train_synthetic_small/",
-        distribution="FullyReplicated",
-        content_type="application/tfrecord",
-        s3_data_type="S3Prefix",
-    )
-    inputs = {"train": train, "test": train}
+    inputs = _get_gpt2_inputs()
     validate_or_skip_smmodelparallel(ecr_image)
     skip_unsupported_instances_smmodelparallel(efa_instance_type)
     mp_params = {
+        **GPT2_BASE_MP_PARAMETERS,
         "partitions": 1,
         "tensor_parallel_degree": 1,
-        "microbatches": 1,
-        "optimize": "speed",
-        "pipeline": "interleaved",
-        "ddp": True,
-        "auto_partition": False,
-        "default_partition": 0,
-        "prescaled_batch": True,
         "sharded_data_parallel_degree": 4,
         "offload_activations": True,
     }
@@ -650,7 +631,7 @@ def test_smmodelparallel_gpt2_sdp_multinode_efa(
                 "mpi": {
                     "enabled": True,
                     "processes_per_host": num_processes,
-                    "custom_mpi_options": "-verbose --mca orte_base_help_aggregate 0 -x SMDEBUG_LOG_LEVEL=error -x OMPI_MCA_btl_vader_single_copy_mechanism=none ",
+                    "custom_mpi_options": MPI_OPTIONS,
                 },
             },
         }
@@ -721,10 +702,14 @@ def _test_dist_operations(
         )
 
 
+@lru_cache(maxsize=None)
+def _get_s3_client(region):
+    return boto3.client("s3", region_name=region)
+
+
 def _assert_s3_file_exists(region, s3_url):
     parsed_url = urlparse(s3_url)
-    s3 = boto3.resource("s3", region_name=region)
-    s3.Object(parsed_url.netloc, parsed_url.path.lstrip("/")).load()
+    _get_s3_client(region).head_object(Bucket=parsed_url.netloc, Key=parsed_url.path.lstrip("/"))
 
 
 def _disable_sm_profiler(region, estimator):
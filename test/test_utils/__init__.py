@@ -8,6 +8,7 @@ import time
 import pprint
 
 from enum import Enum
+from functools import lru_cache
 
 import boto3
 import requests
@@ -1731,6 +1732,7 @@ def get_image_arch_type_from_tag(image_uri):
     return "graviton" if "graviton" in image_uri else "arm64" if "arm64" in image_uri else "x86"
 
 
+@lru_cache(maxsize=None)
 def get_framework_and_version_from_tag(image_uri):
     """
     Return the framework and version from the image tag.
@@ -1825,6 +1827,7 @@ def get_neuron_release_manifest(sdk_version):
     return package_versions
 
 
+@lru_cache(maxsize=None)
 def get_transformers_version_from_image_uri(image_uri):
     """
     Utility function to get the HuggingFace transformers version from an image uri